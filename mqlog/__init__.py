@@ -2,8 +2,79 @@
 
 import asyncio
 import logging
+from collections import deque
 
 _default_formatter = logging.Formatter(logging._default_fmt)
+_batch_formats = (None, "v1")
+
+
+# Append n to buf as a variable-length integer, like MQTT's remaining length
+def _write_varint(buf, n):
+    while n > 0x7F:
+        buf.append((n & 0x7F) | 0x80)
+        n >>= 7
+    buf.append(n)
+
+
+# Return an empty bytearray with room for size bytes. Shrinking a bytearray
+# with a slice assignment keeps its memory, so extending it up to that size
+# afterwards doesn't need to reallocate.
+def _reserve(size):
+    payload = bytearray(size)
+    payload[:] = b""
+    return payload
+
+
+# Count the handlers using a formatter. Caching a formatted record only pays
+# off when another handler may format the same record with it.
+def _share(formatter, n):
+    formatter._mqlog_handlers = getattr(formatter, "_mqlog_handlers", 0) + n
+
+
+# Format a record with a plain Formatter, reusing the result if the same
+# formatter has already formatted this message for another handler. Logger
+# reuses one LogRecord for every message, so the cached string is only valid
+# while the fields that change between messages are the same.
+def _format_cached(formatter, record):
+    if formatter._mqlog_handlers < 2:
+        return formatter.format(record)
+
+    if (
+        getattr(record, "_mqlog_formatter", None) is formatter
+        and record._mqlog_message is record.message
+        and record._mqlog_name == record.name
+        and record._mqlog_levelno == record.levelno
+        and record._mqlog_ct == record.ct
+    ):
+        return record._mqlog_formatted
+
+    formatted = formatter.format(record)
+    record._mqlog_formatter = formatter
+    record._mqlog_message = record.message
+    record._mqlog_name = record.name
+    record._mqlog_levelno = record.levelno
+    record._mqlog_ct = record.ct
+    record._mqlog_formatted = formatted
+    return formatted
+
+
+# Specialize a plain Formatter into a function of the record. Formats without
+# the time skip the dict that Formatter.format builds for every record; those
+# with the time are cached while shared, since formatting the time is the
+# expensive part.
+# Returns None for Formatter subclasses, which may not be specialized.
+def _compile_fast_format(formatter):
+    if type(formatter) is not logging.Formatter:
+        return None
+    if formatter.usesTime():
+        return lambda record: _format_cached(formatter, record)
+
+    fmt = formatter.fmt
+    if fmt == "%(message)s":
+        # Logger doesn't convert the message to a string, so do it here like
+        # Formatter.format would, e.g. for logger.error(exc)
+        return lambda record: str(record.message)
+    return lambda record: fmt % record.__dict__
 
 
 class MqttHandler(logging.Handler):
@@ -19,38 +90,111 @@ class MqttHandler(logging.Handler):
         level=logging.NOTSET,
         flush_level=logging.ERROR,
         capacity=10,
+        max_delay_ms=5,
+        batch_format=None,
     ):
         """
         Initialize the handler with the MQTT client and topic to publish on.
 
         Buffers logs as they come in. If the log level of a record is greater
         than or equal to flush_level, or the buffer is full, the buffer is
-        flushed to the MQTT topic.
+        flushed to the MQTT topic. Once a flush is triggered, the handler
+        waits up to max_delay_ms for more records to join the same publish.
+
+        Records are published as UTF-8 bytes. By default they are joined
+        with newlines. With batch_format="v1", each record is instead
+        prefixed with its length as a variable-length integer, so records
+        containing newlines survive.
         """
         super().__init__(level=level)
 
         if flush_level < level:
             raise ValueError("Flush level must be greater than or equal to level")
+        if batch_format not in _batch_formats:
+            raise ValueError(f"Unknown batch format: {batch_format}")
 
         self.client = client
         self.topic = topic
         self.qos = qos
         self.flush_level = flush_level
         self.capacity = capacity
-        self.buffer = []
-        self.will_flush = asyncio.Event()
+        self.max_delay_ms = max_delay_ms
+        self.batch_format = batch_format
+        self._will_flush = None
+        self._flush_now = None  # created by run(), which waits on it
+        self._effective_formatter = _default_formatter
+        _share(_default_formatter, 1)
+        self._fast_format = _compile_fast_format(_default_formatter)
+        self._pending = []  # publishes awaiting acknowledgement
+        self._failed = False  # set when a publish fails
+        self._confirm_every = 16
+        self._payload = bytearray()  # reused for QoS 0 payloads
+        self._payload_size = 0
         self._logger = logging.getLogger("mqlog")
 
+    @property
+    def capacity(self):
+        return self._capacity
+
+    # Resizing keeps the newest records that fit in the new capacity
+    @capacity.setter
+    def capacity(self, capacity):
+        records = getattr(self, "buffer", ())
+        self._capacity = capacity
+        self.buffer = deque((), capacity)
+        self.buffer.extend(records)
+        self._count_bytes()
+
+    # Created on first use rather than up front, so that handlers that are
+    # constructed before the event loop, or never flushed, don't allocate one.
+    # emit() creates it inline instead of going through this property.
+    @property
+    def will_flush(self):
+        if self._will_flush is None:
+            self._will_flush = asyncio.Event()
+        return self._will_flush
+
     async def run(self):
         """
         Continuously publish log records via MQTT.
         This method should be scheduled as an asyncio task.
         """
+        if self._flush_now is None:
+            self._flush_now = asyncio.Event()
+
         while True:
-            await self.client.up.wait()
+            if self._up:
+                await self._up.wait()
             await self.will_flush.wait()
+
+            # Give a burst of records a chance to go out in a single publish,
+            # but stop waiting as soon as the buffer fills, since it would
+            # start dropping the oldest records. Waiting on the event directly
+            # rather than through wait_for() wakes us before the next record.
+            if self.max_delay_ms and len(self.buffer) < self.capacity:
+                self._flush_now.clear()
+                timer = asyncio.create_task(self._end_delay())
+                await self._flush_now.wait()
+                timer.cancel()
+
             await self._flush()
 
+    # End the wait for more records in run() after max_delay_ms
+    async def _end_delay(self):
+        await asyncio.sleep(self.max_delay_ms / 1000)
+        self._flush_now.set()
+
+    # Clients without an "up" event are assumed to always be connected
+    @property
+    def _up(self):
+        return getattr(self.client, "up", None)
+
+    # Estimate the payload size of the buffered records, allowing a byte per
+    # record for the newline or length prefix. This is kept up to date as
+    # records come in, so _flush() can size the payload up front.
+    def _count_bytes(self):
+        self._buffer_bytes = sum(len(line) + 1 for line in self.buffer)
+
     # Check if we should publish an MQTT message
     def _should_flush(self, record):
         return (len(self.buffer) >= self.capacity) or (
@@ -59,31 +203,159 @@ class MqttHandler(logging.Handler):
 
     # Called by logging.Handler when the logger logs a message
     def emit(self, record):
-        self.buffer.append(self.format(record))
+        # Logger calls emit() on every handler regardless of its level, so
+        # filter here, before spending time formatting records we'd ignore
+        if record.levelno < self.level:
+            return
+
+        # Once the buffer is full, the oldest record is dropped
+        line = self.format(record)
+        if len(self.buffer) == self.capacity:
+            self._buffer_bytes -= len(self.buffer[0]) + 1
+        self.buffer.append(line)
+        self._buffer_bytes += len(line) + 1
 
-        # Prevent buffer from growing indefinitely
-        if self.buffer and len(self.buffer) > self.capacity:
-            self.buffer = self.buffer[-self.capacity :]
+        # A burst of records can each meet the flush conditions; once a flush
+        # has been requested there's no need to check or set it again. The
+        # event is read directly rather than through the property to save a
+        # call per record.
+        will_flush = self._will_flush
+        if will_flush is None:
+            will_flush = self._will_flush = asyncio.Event()
+        if not will_flush.is_set() and self._should_flush(record):
+            will_flush.set()
 
-        if self._should_flush(record):
-            self.will_flush.set()
+        # Cut short the wait for more records in run() once the buffer is full
+        flush_now = self._flush_now
+        if flush_now and len(self.buffer) >= self.capacity:
+            flush_now.set()
+
+    # Resolve the formatter once here rather than on every record, falling
+    # back to the default to prevent errors if there's no formatter set
+    def setFormatter(self, fmt):
+        super().setFormatter(fmt)
+        _share(self._effective_formatter, -1)
+        self._effective_formatter = fmt or _default_formatter
+        _share(self._effective_formatter, 1)
+        self._fast_format = _compile_fast_format(self._effective_formatter)
 
-    # Override Handler.format to prevent errors if there's no formatter set
     def format(self, record):
-        fmt = self.formatter or _default_formatter
-        return fmt.format(record)
+        if self._fast_format:
+            return self._fast_format(record)
+        return self._effective_formatter.format(record)
+
+    # Write a batch of formatted records into the payload bytearray
+    def _encode(self, records, payload):
+        first = True
+        for record in records:
+            data = record.encode()
+            if self.batch_format is None:
+                if not first:
+                    payload.append(0x0A)  # newline
+                first = False
+            else:
+                _write_varint(payload, len(data))
+            payload.extend(data)
+        return payload
 
     # Named with an underscore to avoid conflict with logging.Handler.flush
     async def _flush(self):
+        # The connection may have dropped while we waited to flush. Keep
+        # buffering instead of attempting a publish that's bound to fail; the
+        # event stays set, so run() flushes once the client is back up.
+        if self._up and not self._up.is_set():
+            return
+
+        # Clear the event before publishing rather than after, so that a flush
+        # requested while the publish is in flight isn't lost
+        self.will_flush.clear()
+
+        # Batches fail together when the connection drops, but not in the
+        # order they were published. Wait for the rest of them, then put the
+        # failed ones back in order before publishing anything newer.
+        if self._failed:
+            await self._confirm()
+
         if self.buffer:
-            # Try to publish, but if we fail, just log the error – don't
-            # want to cause cascading errors. Something else is responsible
-            # for bringing the connection back up.
-            msg = "\n".join([line for line in self.buffer])
-            try:
-                await self.client.publish(self.topic, msg, qos=self.qos)
-                self.buffer.clear()
-            except Exception as e:
-                self._logger.error(f"Failed to publish logs via MQTT: {e}")
-            finally:
-                self.will_flush.clear()
+            # Swap out the buffer so that records logged while the publish is
+            # in flight are kept for the next flush instead of being cleared
+            records = self.buffer
+            self.buffer = deque((), self.capacity)
+            size = self._buffer_bytes
+            self._buffer_bytes = 0
+
+            # A single record needs no separator, so its encoding can be
+            # published as is instead of being copied into a payload
+            if len(records) == 1 and self.batch_format is None:
+                msg = records[0].encode()
+
+            # At QoS 0 the client is done with the payload once the publish
+            # returns, so the same bytearray can be reused for every batch.
+            # Emptying it with a slice assignment keeps its allocated capacity.
+            elif not self.qos:
+                if size > self._payload_size:
+                    self._payload = _reserve(size)
+                    self._payload_size = size
+                else:
+                    self._payload[:] = b""
+                msg = self._encode(records, self._payload)
+
+            # Otherwise the payload may be held until it's acknowledged, so it
+            # needs one of its own
+            else:
+                msg = self._encode(records, _reserve(size))
+
+            # At QoS 0 there's nothing to wait for. Otherwise, publish in the
+            # background so that waiting for the broker's acknowledgement
+            # doesn't hold up the next batch.
+            if not self.qos:
+                failed = await self._publish(records, msg)
+                if failed:
+                    self._restore((failed,))
+                return
+
+            # Drop publishes that have already been acknowledged, so that
+            # their records and payloads can be freed between batches. None of
+            # them failed, or they'd have been confirmed above.
+            self._pending = [task for task in self._pending if not task.done()]
+            self._pending.append(asyncio.create_task(self._publish(records, msg)))
+
+            # Wait for acknowledgements once enough batches are outstanding,
+            # rather than after each one, so that the number in flight stays
+            # bounded. If any of them failed, the group goes back in order.
+            if len(self._pending) >= self._confirm_every:
+                await self._confirm()
+
+    # Wait for all outstanding publishes, restoring the records of any that
+    # failed. gather() returns results in the order the batches were published.
+    async def _confirm(self):
+        results = await asyncio.gather(*self._pending)
+        self._pending.clear()
+        if self._failed:
+            self._restore(results)
+
+    # Put the records of failed publishes back ahead of any newer ones, oldest
+    # batch first. Batches that went out have no records to restore.
+    def _restore(self, failed):
+        # The capacity may have changed during the publish, so rebuild the
+        # buffer rather than reusing a swapped out one
+        buffer = deque((), self.capacity)
+        for records in failed:
+            if records:
+                buffer.extend(records)
+        buffer.extend(self.buffer)
+        self.buffer = buffer
+        self._failed = False
+        self._count_bytes()
+
+    # Publish a batch of records, returning them if the publish fails
+    async def _publish(self, records, msg):
+        # Try to publish, but if we fail, just log the error – don't
+        # want to cause cascading errors. Something else is responsible
+        # for bringing the connection back up.
+        try:
+            await self.client.publish(self.topic, msg, qos=self.qos)
+        except Exception as e:
+            self._logger.error(f"Failed to publish logs via MQTT: {e}")
+            self._failed = True
+            return records
@@ -7,11 +7,18 @@ from mqlog import MqttHandler
 from tests.utils import AsyncMock, Mock, call
 
 
+class PublishMock(AsyncMock):
+    """An AsyncMock that copies the payload, which the handler may reuse."""
+
+    async def __call__(self, topic, msg, qos=0):
+        return await super().__call__(topic, bytes(msg), qos=qos)
+
+
 class FakeClient:
     """A fake MQTT client for testing purposes."""
 
     def __init__(self):
-        self.publish = AsyncMock()
+        self.publish = PublishMock()
         self.up = asyncio.Event()
 
 
@@ -26,7 +33,6 @@ class TestMqttHandler(TestCase):
 
     def tearDown(self):
         """Clean up after each test"""
-        self.handler.buffer.clear()
         self.handler.will_flush.clear()
         self.client.up.clear()
 
@@ -35,6 +41,96 @@ class TestMqttHandler(TestCase):
         self.handler.setFormatter(None)
         self.logger.info("Test message")  # Would error if no formatter
 
+    def test_formatter(self):
+        """Handler should format records with the formatter that is set"""
+        self.handler.setFormatter(logging.Formatter("%(levelname)s %(message)s"))
+        self.logger.info("Test message 1")
+        self.handler.setFormatter(logging.Formatter("%(message)s"))
+        self.logger.info("Test message 2")
+        self.assertEqual(
+            list(self.handler.buffer), ["INFO Test message 1", "Test message 2"]
+        )
+
+    def test_format_non_string_message(self):
+        """Handler should format messages that aren't strings"""
+        self.handler.setFormatter(logging.Formatter("%(message)s"))
+        self.logger.error(ValueError("boom"))
+        self.logger.info(42)
+        self.assertEqual(list(self.handler.buffer), ["boom", "42"])
+
+    def test_custom_formatter(self):
+        """Handler should use the format method of a Formatter subclass"""
+
+        class UpperFormatter(logging.Formatter):
+            def format(self, record):
+                return super().format(record).upper()
+
+        self.handler.setFormatter(UpperFormatter("%(message)s"))
+        self.logger.info("Test message")
+        self.assertEqual(list(self.handler.buffer), ["TEST MESSAGE"])
+
+    def test_shared_formatter(self):
+        """Handlers sharing a formatter should format each record once"""
+        formatter = logging.Formatter("%(asctime)s %(message)s")
+        formatted = []
+        format_record = formatter.format
+
+        def counting_format(record):
+            formatted.append(record)
+            return format_record(record)
+
+        formatter.format = counting_format
+
+        handler = MqttHandler(FakeClient(), "other_topic")
+        handler.setFormatter(formatter)
+        self.handler.setFormatter(formatter)
+        self.logger.addHandler(handler)
+        try:
+            self.logger.info("Test message 1")
+            self.logger.info("Test message 2")
+        finally:
+            self.logger.handlers.remove(handler)
+
+        self.assertEqual(len(formatted), 2)
+        self.assertEqual(list(handler.buffer), list(self.handler.buffer))
+
+    def test_shared_formatter_reused_record(self):
+        """A reused record with a different logger name should be reformatted"""
+        formatter = logging.Formatter("%(asctime)s %(name)s %(message)s")
+        handler = MqttHandler(FakeClient(), "other_topic")
+        handler.setFormatter(formatter)
+        self.handler.setFormatter(formatter)
+
+        record = logging.LogRecord()
+        record.set("first", logging.INFO, "Test message")
+        ct = record.ct
+        handler.emit(record)
+        self.handler.emit(record)
+        record.set("second", logging.INFO, "Test message")
+        record.ct = ct
+        handler.emit(record)
+        self.handler.emit(record)
+
+        names = [line.split(" ")[-3] for line in self.handler.buffer]
+        self.assertEqual(names, ["first", "second"])
+
+    def test_unshared_formatter_not_cached(self):
+        """A formatter used by a single handler shouldn't cache on the record"""
+        self.handler.setFormatter(logging.Formatter("%(asctime)s %(message)s"))
+        record = logging.LogRecord()
+        record.set("test", logging.INFO, "Test message")
+        self.handler.emit(record)
+        self.assertFalse(hasattr(record, "_mqlog_formatted"))
+
+    def test_emit_below_level(self):
+        """Handler should ignore records below its level"""
+        self.handler.setLevel(logging.WARNING)
+        record = logging.LogRecord()
+        record.set("test", logging.INFO, "Test message")
+        self.handler.emit(record)
+        self.logger.info("Test message")
+        self.assertEqual(len(self.handler.buffer), 0)
+
     def test_no_flush(self):
         """Buffer should not be flushed until capacity/level reached"""
         self.handler.flush_level = logging.WARNING
@@ -69,6 +165,56 @@ class TestMqttHandler(TestCase):
 
         self.handler._logger.error.assert_called()
 
+    def test_flush_fail_keeps_buffer(self):
+        """Records should stay buffered if publish fails"""
+        self.handler._logger.error = Mock()
+        self.client.publish.side_effect = Exception("Publish failed")
+
+        async def do_test(handler: logging.Handler, logger: logging.Logger):
+            asyncio.create_task(handler.run())
+            await asyncio.sleep(0.1)
+            logger.info("Test message 1")
+            logger.error("Test message 2")  # should trigger flush
+            await asyncio.sleep(0.1)
+
+        asyncio.run(do_test(self.handler, self.logger))
+
+        self.assertEqual(
+            list(self.handler.buffer),
+            ["INFO:test:Test message 1", "ERROR:test:Test message 2"],
+        )
+
+    def test_flush_fail_after_resize(self):
+        """Records restored after a failed publish should fit the new capacity"""
+        self.handler._logger.error = Mock()
+        publish = self.client.publish
+        publish.side_effect = Exception("Publish failed")
+
+        async def slow_publish(topic, msg, qos=0):
+            await asyncio.sleep(0.1)
+            return await publish(topic, msg, qos=qos)
+
+        self.client.publish = slow_publish
+
+        async def do_test(handler: logging.Handler, logger: logging.Logger):
+            asyncio.create_task(handler.run())
+            await asyncio.sleep(0.1)
+            for i in range(5):
+                logger.info(f"Test message {i}")
+            logger.error("Test message 5")  # should trigger flush
+            await asyncio.sleep(0.05)
+            handler.capacity = 2  # while the publish is in flight
+            await asyncio.sleep(0.1)
+
+        asyncio.run(do_test(self.handler, self.logger))
+
+        self.assertEqual(
+            list(self.handler.buffer),
+            ["INFO:test:Test message 4", "ERROR:test:Test message 5"],
+        )
+        self.logger.info("Test message 6")
+        self.assertEqual(len(self.handler.buffer), 2)
+
     def test_publish(self):
         """Flushing should publish messages to MQTT topic"""
         self.handler.flush_level = logging.ERROR
@@ -84,9 +230,52 @@ class TestMqttHandler(TestCase):
         asyncio.run(do_test(self.handler, self.logger))
 
         self.client.publish.assert_called_with(
-            "test_topic", "INFO:test:Test message 1\nERROR:test:Test message 2", qos=0
+            "test_topic",
+            b"INFO:test:Test message 1\nERROR:test:Test message 2",
+            qos=0,
+        )
+
+    def test_publish_empty_messages(self):
+        """Empty messages should keep their newline separators"""
+        self.handler.setFormatter(logging.Formatter("%(message)s"))
+
+        async def do_test(handler: logging.Handler, logger: logging.Logger):
+            asyncio.create_task(handler.run())
+            await asyncio.sleep(0.1)
+            logger.info("")
+            logger.info("a")
+            logger.info("")
+            logger.error("b")
+            await asyncio.sleep(0.1)
+
+        asyncio.run(do_test(self.handler, self.logger))
+
+        self.client.publish.assert_called_with("test_topic", b"\na\n\nb", qos=0)
+
+    def test_publish_batch_format(self):
+        """Records should be length-prefixed with the v1 batch format"""
+        self.handler.batch_format = "v1"
+
+        async def do_test(handler: logging.Handler, logger: logging.Logger):
+            asyncio.create_task(handler.run())
+            await asyncio.sleep(0.1)
+            logger.info("Test message 1")
+            logger.error("Test\nmessage 2")
+            await asyncio.sleep(0.1)
+
+        asyncio.run(do_test(self.handler, self.logger))
+
+        self.client.publish.assert_called_with(
+            "test_topic",
+            b"\x18INFO:test:Test message 1\x19ERROR:test:Test\nmessage 2",
+            qos=0,
         )
 
+    def test_invalid_batch_format(self):
+        """Handler should reject unknown batch formats"""
+        with self.assertRaises(ValueError):
+            MqttHandler(self.client, "test_topic", batch_format="v2")
+
     def test_flush_multiple(self):
         """Flushing multiple times should publish separate messages"""
         self.handler.capacity = 2
@@ -109,17 +298,238 @@ class TestMqttHandler(TestCase):
             [
                 call(
                     "test_topic",
-                    "INFO:test:Test message 1\nINFO:test:Test message 2",
+                    b"INFO:test:Test message 1\nINFO:test:Test message 2",
                     qos=0,
                 ),
                 call(
                     "test_topic",
-                    "INFO:test:Test message 3\nINFO:test:Test message 4",
+                    b"INFO:test:Test message 3\nINFO:test:Test message 4",
                     qos=0,
                 ),
             ]
         )
 
+    def test_flush_delay(self):
+        """Records logged shortly after a flush trigger should be batched"""
+        self.handler.max_delay_ms = 50
+
+        async def do_test(handler: logging.Handler, logger: logging.Logger):
+            asyncio.create_task(handler.run())
+            await asyncio.sleep(0.1)
+            logger.error("Test message 1")
+            await asyncio.sleep(0.01)
+            logger.info("Test message 2")  # within the delay window
+            await asyncio.sleep(0.1)
+
+        asyncio.run(do_test(self.handler, self.logger))
+
+        self.client.publish.assert_has_calls(
+            [
+                call(
+                    "test_topic",
+                    b"ERROR:test:Test message 1\nINFO:test:Test message 2",
+                    qos=0,
+                )
+            ]
+        )
+
+    def test_flush_delay_full_buffer(self):
+        """A burst that fills the buffer during the delay shouldn't drop records"""
+        self.handler.max_delay_ms = 100
+
+        async def do_test(handler: logging.Handler, logger: logging.Logger):
+            asyncio.create_task(handler.run())
+            await asyncio.sleep(0.1)
+            logger.error("Test message 0")
+            for i in range(1, 31):
+                logger.info(f"Test message {i}")
+                await asyncio.sleep(0)
+            await asyncio.sleep(0.2)
+
+        asyncio.run(do_test(self.handler, self.logger))
+
+        # Everything was either published or is still waiting in the buffer
+        published = b"\n".join(args[1] for args, _ in self.client.publish._calls)
+        self.assertEqual(
+            published.decode().split("\n") + list(self.handler.buffer),
+            ["ERROR:test:Test message 0"]
+            + [f"INFO:test:Test message {i}" for i in range(1, 31)],
+        )
+
+    def test_flush_during_publish(self):
+        """A flush requested while publishing should publish the new records"""
+        publish = self.client.publish
+
+        async def slow_publish(topic, msg, qos=0):
+            await asyncio.sleep(0.1)
+            return await publish(topic, msg, qos=qos)
+
+        self.client.publish = slow_publish
+
+        async def do_test(handler: logging.Handler, logger: logging.Logger):
+            asyncio.create_task(handler.run())
+            await asyncio.sleep(0.1)
+            logger.error("Test message 1")
+            await asyncio.sleep(0.05)
+            logger.error("Test message 2")  # while message 1 is publishing
+            await asyncio.sleep(0.3)
+
+        asyncio.run(do_test(self.handler, self.logger))
+
+        publish.assert_has_calls(
+            [
+                call("test_topic", b"ERROR:test:Test message 1", qos=0),
+                call("test_topic", b"ERROR:test:Test message 2", qos=0),
+            ]
+        )
+
+    def test_publish_without_waiting_for_ack(self):
+        """At QoS 1, batches should publish without waiting for the last ack"""
+        self.handler.qos = 1
+        publish = self.client.publish
+
+        async def slow_ack_publish(topic, msg, qos=0):
+            await publish(topic, msg, qos=qos)
+            await asyncio.sleep(0.5)  # Simulate waiting for PUBACK
+
+        self.client.publish = slow_ack_publish
+
+        async def do_test(handler: logging.Handler, logger: logging.Logger):
+            asyncio.create_task(handler.run())
+            await asyncio.sleep(0.1)
+            logger.error("Test message 1")
+            await asyncio.sleep(0.05)
+            logger.error("Test message 2")  # before message 1 is acknowledged
+            await asyncio.sleep(0.05)
+
+        asyncio.run(do_test(self.handler, self.logger))
+
+        publish.assert_has_calls(
+            [
+                call("test_topic", b"ERROR:test:Test message 1", qos=1),
+                call("test_topic", b"ERROR:test:Test message 2", qos=1),
+            ]
+        )
+
+    def test_publish_waits_for_acks(self):
+        """At QoS 1, the handler should wait for acks every few batches"""
+        self.handler.qos = 1
+        self.handler._confirm_every = 2
+        publish = self.client.publish
+
+        async def slow_ack_publish(topic, msg, qos=0):
+            await publish(topic, msg, qos=qos)
+            await asyncio.sleep(0.2)  # Simulate waiting for PUBACK
+
+        self.client.publish = slow_ack_publish
+
+        async def do_test(handler: logging.Handler, logger: logging.Logger):
+            asyncio.create_task(handler.run())
+            await asyncio.sleep(0.1)
+            for i in range(3):
+                logger.error(f"Test message {i}")
+                await asyncio.sleep(0.02)
+
+            # Third batch waits until the first two are acknowledged
+            await asyncio.sleep(0.05)
+            self.assertEqual(len(publish._calls), 2)
+            await asyncio.sleep(0.2)
+            self.assertEqual(len(publish._calls), 3)
+
+        asyncio.run(do_test(self.handler, self.logger))
+
+    def test_publish_waits_for_acks_fail(self):
+        """At QoS 1, a failed group of batches should be restored in order"""
+        self.handler.qos = 1
+        self.handler._confirm_every = 2
+        self.handler._logger.error = Mock()
+        publish = self.client.publish
+        publish.side_effect = Exception("Publish failed")
+
+        async def slow_publish(topic, msg, qos=0):
+            await asyncio.sleep(0.1)
+            return await publish(topic, msg, qos=qos)
+
+        self.client.publish = slow_publish
+
+        async def do_test(handler: logging.Handler, logger: logging.Logger):
+            asyncio.create_task(handler.run())
+            await asyncio.sleep(0.1)
+            logger.error("Test message 1")
+            await asyncio.sleep(0.02)
+            logger.error("Test message 2")  # waits for both to be acknowledged
+            await asyncio.sleep(0.02)
+            logger.info("Test message 3")
+            await asyncio.sleep(0.2)
+
+        asyncio.run(do_test(self.handler, self.logger))
+
+        self.assertEqual(
+            list(self.handler.buffer),
+            [
+                "ERROR:test:Test message 1",
+                "ERROR:test:Test message 2",
+                "INFO:test:Test message 3",
+            ],
+        )
+
+    def test_acknowledged_publishes_released(self):
+        """At QoS 1, acknowledged publishes should not be kept around"""
+        self.handler.qos = 1
+
+        async def do_test(handler: logging.Handler, logger: logging.Logger):
+            asyncio.create_task(handler.run())
+            await asyncio.sleep(0.1)
+            for i in range(3):
+                logger.error(f"Test message {i}")
+                await asyncio.sleep(0.05)
+
+        asyncio.run(do_test(self.handler, self.logger))
+
+        self.assertEqual(len(self.client.publish._calls), 3)
+        self.assertEqual(len(self.handler._pending), 1)  # only the latest
+
+    def test_flush_fail_keeps_order(self):
+        """At QoS 1, failed batches in flight should be restored in order"""
+        self.handler.qos = 1
+        self.handler._logger.error = Mock()
+        publish = self.client.publish
+        publish.side_effect = Exception("Publish failed")
+
+        async def slow_publish(topic, msg, qos=0):
+            await asyncio.sleep(0.1)
+            return await publish(topic, msg, qos=qos)
+
+        self.client.publish = slow_publish
+
+        async def do_test(
+            handler: logging.Handler, logger: logging.Logger, client: FakeClient
+        ):
+            asyncio.create_task(handler.run())
+            await asyncio.sleep(0.1)
+            logger.error("Test message 1")
+            await asyncio.sleep(0.02)
+            logger.error("Test message 2")  # while message 1 is in flight
+            await asyncio.sleep(0.02)
+            logger.info("Test message 3")
+            client.up.clear()  # both publishes fail
+            await asyncio.sleep(0.2)
+
+            # Simulate reconnect
+            publish.side_effect = None
+            logger.error("Test message 4")
+            client.up.set()
+            await asyncio.sleep(0.2)
+
+        asyncio.run(do_test(self.handler, self.logger, self.client))
+
+        publish.assert_called_with(
+            "test_topic",
+            b"ERROR:test:Test message 1\nERROR:test:Test message 2\n"
+            b"INFO:test:Test message 3\nERROR:test:Test message 4",
+            qos=1,
+        )
+
     def test_buffer_overflow(self):
         """Buffer should get truncated if it exceeds capacity"""
         self.handler.capacity = 3
@@ -140,7 +550,7 @@ class TestMqttHandler(TestCase):
         asyncio.run(do_test(self.handler, self.logger))
 
         self.assertEqual(
-            self.handler.buffer,
+            list(self.handler.buffer),
             [
                 "INFO:test:Test message 2",
                 "INFO:test:Test message 3",
@@ -148,6 +558,53 @@ class TestMqttHandler(TestCase):
             ],
         )
 
+    def test_disconnect_before_flush(self):
+        """Handler should keep buffering if the client goes down before a flush"""
+        self.handler.max_delay_ms = 50
+
+        async def do_test(
+            handler: logging.Handler, logger: logging.Logger, client: FakeClient
+        ):
+            asyncio.create_task(handler.run())
+            await asyncio.sleep(0.1)
+            logger.error("Test message 1")
+            await asyncio.sleep(0.01)
+
+            # Simulate disconnect within the delay window
+            client.up.clear()
+            await asyncio.sleep(0.1)
+            client.publish.assert_not_awaited()
+
+            # Simulate reconnect
+            client.up.set()
+            await asyncio.sleep(0.1)
+
+        asyncio.run(do_test(self.handler, self.logger, self.client))
+
+        self.client.publish.assert_called_with(
+            "test_topic", b"ERROR:test:Test message 1", qos=0
+        )
+
+    def test_client_without_up(self):
+        """Handler should publish via clients that don't report connectivity"""
+        client = FakeClient()
+        del client.up
+        handler = MqttHandler(client, "test_topic")
+        record = logging.LogRecord()
+        record.set("test", logging.ERROR, "Test message 1")
+
+        async def do_test(handler: logging.Handler):
+            asyncio.create_task(handler.run())
+            await asyncio.sleep(0.1)
+            handler.emit(record)
+            await asyncio.sleep(0.1)
+
+        asyncio.run(do_test(handler))
+
+        client.publish.assert_called_with(
+            "test_topic", b"ERROR:test:Test message 1", qos=0
+        )
+
     def test_reconnect(self):
         """Handler should reconnect and publish messages after a disconnect"""
         self.client.up.clear()  # Simulate client being disconnected
@@ -167,7 +624,7 @@ class TestMqttHandler(TestCase):
         asyncio.run(do_test(self.handler, self.logger, self.client))
 
         self.client.publish.assert_called_with(
-            "test_topic", "ERROR:test:Test message 1", qos=0
+            "test_topic", b"ERROR:test:Test message 1", qos=0
         )
 
 